@@ -9,7 +9,7 @@
 # [Video](https://github.com/user-attachments/assets/16422a6b-2bad-4d12-b3fb-853ec489fe00)
 # 
 # Howto execute:
-# 1. You need to have Python3 installed; inside Python3 it needs matplotlib library installed
+# 1. You need to have Python3 installed; inside Python3 it needs matplotlib and numpy libraries installed (numba is optional and speeds up the angle calculation)
 # 2. EVM of [TMF882X](https://ams-osram.com/products/boards-kits-accessories/kits/ams-tmf882x-evm-db-demo-evaluation-kit) installed and EVM GUI running before starting the script
 # 3. Double click 'keystone.py' or execute 'keystone.ipynb' in a JupyterLab environment
 # 
@@ -55,6 +55,12 @@
 # $\gamma = \arcsin \frac{b \sin \alpha }{a} $
 # 
 # $\phi = 90^\circ - \gamma$  
+# 
+# ### Implementation
+# The script uses an equivalent closed form which avoids the ambiguity of $\arcsin$:  
+# place the sensor in the origin with the center zone along the y axis, so the wall passes through $(0, c)$ and $(b \sin \alpha, b \cos \alpha)$
+# 
+# $\phi = \operatorname{atan2}(c - b \cos \alpha, b \sin \alpha)$
 
 # In[1]:
 
@@ -75,167 +81,279 @@
 
 import math
 import socket 
+import threading
+import queue
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import matplotlib.gridspec as gridspec
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # numba is optional - the angle calculation falls back to plain numpy
+
+
+# angles between center zone and edge zones (defined by SPAD mask) never change, so do all trigonometry on them once
+_ALPHA_UD = math.radians(32/3)  # angle between center and up / down zone
+_ALPHA_LR = math.radians(33/3)  # angle between center and left / right zone
+_SIN_UD, _COS_UD = math.sin(_ALPHA_UD), math.cos(_ALPHA_UD)
+_SIN_LR, _COS_LR = math.sin(_ALPHA_LR), math.cos(_ALPHA_LR)
+# same values ordered as top / bottom / left / right zone
+_SIN_ALPHAS = np.array([_SIN_UD, _SIN_UD, _SIN_LR, _SIN_LR])
+_COS_ALPHAS = np.array([_COS_UD, _COS_UD, _COS_LR, _COS_LR])
+_RAD2DEG = 180 / math.pi
+
 
+def _angle_kernel(center, edges, sin_a, cos_a):
+    '''angle of the wall through (0, center) and (edge*sin_a, edge*cos_a) - see calc_angles'''
+    # atan2 returns the correct sign directly - no ambiguity check needed as with asin
+    return np.arctan2(center - edges*cos_a, edges*sin_a) * _RAD2DEG
 
-def calc_angle(center, edge, alpha):
+
+if njit is not None:
+    _angle_kernel = njit(cache=True, fastmath=True)(_angle_kernel)
+
+
+def calc_angles(center, edges, sin_a=_SIN_ALPHAS, cos_a=_COS_ALPHAS):
     '''
     Args:
-        Calculate angle of triangle to a perpendicular wall where
+        Calculate angles of triangles to a perpendicular wall for all edge zones at once where
 
-        alpha = angle between dist1 and dist2 (defined by SPAD mask) in degrees
+        sin_a, cos_a = sine / cosine of angles between center and edge zones (defined by SPAD mask)
         center = distance of center zone in [mm]
-        edge = distance of edge zone in [mm]
+        edges = distances of edge zones in [mm]; same order as sin_a / cos_a
 
     Returns:
-        angle in degrees (not radians)
+        array of angles in degrees (not radians)
     '''
-    try:
-        # apply law of cosines to get third length of triangle
-        a = math.sqrt(center**2 + edge**2 
-                      - 2 * center * edge * math.cos(math.radians(alpha)))
-        # apply law of sines to calculate angles in triangle
-        gamma = math.degrees(math.asin(edge / a * math.sin(math.radians(alpha))))
-        phi = 90 - gamma
-        # note: asin is ambiguous - cannot check if we are above or below perpendicular
-        # check this wiht pythagoras
-        if edge**2 > center**2 + a**2:
-            phi = -phi
-        return (phi)
-    except ZeroDivisionError:
-        return (0)
+    edges = np.asarray(edges, dtype=np.float64)
+    if center == 0:
+        # no target in center zone - there is no wall angle; atan2 would give -(90° - alpha) here, so return
+        # +(90° - alpha) for edge zones with a target as before to keep the 'out of range' (red) warning
+        return np.where(edges > 0, np.arctan2(cos_a, sin_a) * _RAD2DEG, 0.0)
+    return _angle_kernel(float(center), edges, sin_a, cos_a)
 
 
 # In[4]:
 
 
 tof_id = None # tof unique ID
+FRAME_BUDGET_MS = 300  # animation interval; frames without new data from the EVM GUI are not updated
+latest = queue.Queue(maxsize=1)  # most recent result of get_data_from_EVM_GUI - older ones are dropped
+rx_buffer = bytearray()  # data received from the EVM GUI that is not processed yet; kept across calls
+
+
+def start_measurement(sock):
+    '''Request the next measurement from the EVM GUI; its data is collected by get_data_from_EVM_GUI
+    Args:
+        sock -- an open socket for the connection to the EVM GUI
+    '''
+    sock.sendall(b'(m0)')  # run measurement command 'm'
+
+
+def _h_hlong(line, meas):
+    '''#HLONGxy - histogram record'''
+    # do whatever needs to be done with histograms... only an example is shown below
+    entry = line[7] - ord('0')  # which histogram? tag is #HLONGxy
+    parts = line.split(b';', 21)  # only the first 20 bins are needed - don't split the rest
+    pt_hist = np.array(parts[1:21], dtype=np.int32)  # convert to int array
+    meas['xtalk'][entry] = pt_hist[5:20].max()  # search for the crosstalk peak
+    # background light calculation: max(avg bins 0-8)
+    meas['background'][entry] = pt_hist[0:8].mean()
+
+
+def _h_obj(line, meas):
+    '''#OBJ - object record; always the last entry of a measurement'''
+    obj = np.array(line.split(b';')[5:], dtype=np.int32)  # convert to int array removing other information
+    if obj.size < 9*4:  # distance / confidence of 2 objects for each of the 9 zones
+        raise ValueError(f'incomplete object data - {obj.size} values')
+    meas['obj'] = obj
+
+
+def _h_itt(line, meas):
+    '''#ITT - iterations record'''
+    meas['iterations'] = int(line.split(b';', 3)[2])
+
+
+def _h_ver(line, meas):
+    '''#VER - version record'''
+    global tof_id
+    data = line.decode('ascii').split(';')
+    tof_id = f'TMF882X ID {data[1]} - App {data[2]} - Drv {data[3]}'
+
+
+def _new_measurement():
+    '''Empty measurement - fresh arrays for each call as the previous result may still be shown'''
+    return {'xtalk': np.zeros(10, dtype=np.int32), 'background': np.zeros(10, dtype=np.float32),
+            'iterations': 0, 'obj': None}
+
+# record handlers by the full tag up to the first ';'; header lines and unknown records have no handler
+HANDLERS = {b'#OBJ': _h_obj, b'#ITT': _h_itt, b'#VER': _h_ver}
+HANDLERS.update({b'#HLONG%02d' % xy: _h_hlong for xy in range(100)})  # #HLONGxy - any x, entry is y as before
 
 
 def get_data_from_EVM_GUI(sock) -> (str, int, int, int, int):
     '''Process information from TMF882X EVM GUI and extract data as needed
+    The measurement has to be requested once with start_measurement before the first call; after each
+    measurement the next one is requested right away so the EVM measures while the result is drawn.
     Args:
         sock -- an open socket for the connection to the EVM GUI; connection errors need to be handled in calling function
 
     Returns:    
         string description -- a textual description for displaying the result or any error
-        int xtalk -- integer with amount of crosstalk; returns 0 in case of error
-        int background -- the amount of background light, should be much lower than xtalk
+        xtalk -- int array with amount of crosstalk per histogram; returns 0 in case of error
+        background -- float array with the amount of background light, should be much lower than xtalk
         int iterations -- number of iterations for this measurement
-        obj -- object data; array of integers of distance / confidence for each channel
+        obj -- object data; int array of distance / confidence for each channel
     '''
-    xtalk = [0]*10  # initialize
-    background = [0]*10
-    iterations = 0
-    obj = None  # initialize
-    sock.sendall(b'(m0)')  # run measurement command 'm'
+    global tof_id
+    meas = _new_measurement()
+    result, result_end = None, 0  # newest measurement whose OBJ record parsed and the buffer offset after it
     while True:
-        global tof_id
+        offset = 0  # start of the first line not processed yet
+        while True:  # only process complete lines - a line can be split over several recv calls
+            end = rx_buffer.find(b'\r\n', offset)
+            if end < 0:
+                break
+            line = bytes(rx_buffer[offset:end])
+            offset = end + 2  # the line is consumed even if it cannot be parsed below
+            handler = HANDLERS.get(line.partition(b';')[0])
+            if handler is None:
+                continue
+            try:
+                handler(line, meas)
+            except (ValueError, IndexError):
+                continue  # skip malformed record - header lines and unknown records never reach a handler
+            if meas['obj'] is not None:  # OBJ is always the last entry
+                # keep parsing - if we are behind, a newer measurement is already buffered and drawn instead
+                result, result_end = meas, offset
+                meas = _new_measurement()
+        if result is not None:  # no complete line left
+            del rx_buffer[:result_end]  # keep anything after this record for the next call
+            start_measurement(sock)  # next measurement runs while this one is drawn
+            xtalk, background = result['xtalk'], result['background']
+            return (f'XTalk {xtalk} BG {background}', xtalk, background, result['iterations'], result['obj'])
+        del rx_buffer[:offset]  # drop processed lines once per recv instead of once per line
         try:
-            s = str(sock.recv(10000), 'utf-8')
-            entries = s.split('\r\n')  # we could have read several lines, so process them one by one
-            for item in entries:
-                try:
-                    data = item.split(';')
-                    if data[0] == '#VER':
-                        tof_id = f'TMF882X ID {data[1]} - App {data[2]} - Drv {data[3]}'
-                    if data[0][0:6] == '#HLONG':  # histograms
-                        # do whatever needs to be done with histograms... only an example is shown below
-                        entry = int(data[0][7]) # which histogram?
-                        pt_hist = [int(x) for x in data[1:]]  # convert to int list
-                        xtalk[entry] = max(pt_hist[5:20])  # search for the crosstalk peak
-                        # background light calculation: max(avg bins 0-8)
-                        background[entry] = sum(pt_hist[0:8])/8
-                    if data[0] == '#OBJ':  # OBJ is always the last entry
-                        obj = [int(x) for x in data[5:]]  # convert to int list removing other information
-                        return (f'XTalk {xtalk} BG {background}', xtalk, background, iterations, obj)
-                    if data[0] == '#ITT':  # iterations
-                        iterations = int(data[2])
-                except (ValueError, IndexError) as e:
-                    pass  # to ignore header lines as they raise an exception if converted to int()
+            chunk = sock.recv(65536)  # drain as much as the kernel has buffered in one call
         except socket.timeout:
             tof_id = ''
+            start_measurement(sock)  # request again in case the EVM GUI missed it or was restarted
             return('No device connected', 0, 0, 0, None)
+        if not chunk:
+            tof_id = ''
+            raise ConnectionError('EVM GUI closed the connection')
+        rx_buffer.extend(chunk)
 
 
-def pick_best(obj):
-    '''Check if there is a second target and use this if it has higher confidence
+def reader_loop(sock):
+    '''Read measurements from the EVM GUI in a background thread so the GUI never waits for the socket
     Args:
-        obj -- object data; array of integers of distance / confidence for each channel
-    Returns:
-        single selected object
+        sock -- an open socket for the connection to the EVM GUI
     '''
-    if obj[1] > obj[3]:  # compare confidence first/second target
-        return obj[0]  # return first target
-    else:
-        return obj[2]  # return second target1
+    connected = True
+    while connected:
+        try:
+            data = get_data_from_EVM_GUI(sock)
+        except socket.error:  # connection lost or socket closed on exit - nothing to read anymore
+            data = ('No device connected', 0, 0, 0, None)
+            connected = False
+        except Exception as e:  # any other error would end this thread silently and freeze the last frame
+            print(f'Reading from TMF882X EVM GUI stopped - Error: {e!r}')
+            data = ('No device connected', 0, 0, 0, None)
+            connected = False
+        try:
+            latest.get_nowait()  # drop the result animate did not pick up yet
+        except queue.Empty:
+            pass
+        latest.put_nowait(data)
 
 
-def animate(i, axs, sock):
-    '''Run animantion
+def init_artists(axs):
+    '''Create all texts and the 3d object once; animate only updates them
     Args:
-        i -- needed for animation call
         axs -- axes for drawings
-        sock -- socket for communication
+    Returns:
+        zone_texts -- for each zone one text for distance / confidence of first and second target
+        info_texts -- texts of information frame: tof id, angles, axes, error
     '''
-    description, xtalk, background, iterations, obj = get_data_from_EVM_GUI(sock)
     for i in range(10):
-        axs[i].clear()
         axs[i].set_xticks([])  # hide axes
         axs[i].set_yticks([])  # hide axes
+    zone_texts = [axs[i].text(0.5, 0.5, '', ha='center', va='center', linespacing=2.0) for i in range(9)]
     ax_info = axs[9]
     ax_info.set(frame_on=False)
+    info_texts = [ax_info.text(0.5, 0.7, '', ha='center', va='center'),  # tof id
+                  ax_info.text(0.5, 0.5, '', ha='center', va='center'),  # angles
+                  ax_info.text(0.5, 0.3, '', ha='center', va='center'),  # axes
+                  ax_info.text(0.1, 0.5, '', ha='left', va='center', color='red')]  # error
     ax3d = axs[10]
     ax3d.axis('off')
     ax3d.set_xlim(-1.5, 2.5)
     ax3d.set_ylim(-0.2, 1.2)
-    if obj:
+    ax3d.bar3d([0], [0], [0], [1], [1], [1], shade=True, color='cornflowerblue')  # only rotated by animate
+    return zone_texts, info_texts
+
+
+def animate(i, axs, sock, zone_texts, info_texts):
+    '''Run animantion
+    Args:
+        i -- needed for animation call
+        axs -- axes for drawings
+        sock -- socket for communication; read by reader_loop
+        zone_texts, info_texts -- texts created by init_artists
+    Returns:
+        artists that were updated - needed for blitting
+    '''
+    info_id, info_angles, info_axes, info_error = info_texts
+    ax3d = axs[10]
+    # the 3d axes is redrawn as a whole as its projection changes with the view
+    artists = zone_texts + list(info_texts) + [ax3d]
+    try:
+        description, xtalk, background, iterations, obj = latest.get_nowait()
+    except queue.Empty:
+        # no new measurement yet - skip updating this frame; the unchanged artists are still returned as
+        # blitting would otherwise erase them
+        return artists
+    if obj is not None:
+        info_error.set_text('')
         try:
             for i in range(9): # iterate over zones
                 index = i*4  # index into objects
-                if (obj[index]>0):
-                    axs[i].annotate(f'{obj[index]}mm', (0.5, 0.8), ha='center', va='center')   # distance
-                    axs[i].annotate(f'conf {obj[index+1]}', (0.5, 0.6), ha='center', va='center') # confidence
-                if (obj[index+2]>0):  # second object?
-                    axs[i].annotate(f"{obj[index+2]}mm", (0.5, 0.4), ha='center', va='center')   # distance
-                    axs[i].annotate(obj[index+3], (0.5, 0.2), ha='center', va='center') # confidence   
+                # one line each for distance and confidence; empty lines keep the second object in the lower half
+                first = f'{obj[index]}mm\nconf {obj[index+1]}' if obj[index] > 0 else '\n'
+                second = f'{obj[index+2]}mm\n{obj[index+3]}' if obj[index+2] > 0 else '\n'  # second object?
 #                # add background and crosstalk - uncomment if you want to show this parameters as well
-#                axs[i].annotate(f'xtalk {xtalk[i+1]}', (0.5, 0.4), ha='center', va='center')
-#                axs[i].annotate(f'ambient bg. {int(background[i+1])}', (0.5, 0.2), ha='center', va='center')
+#                second = f'xtalk {xtalk[i+1]}\nambient bg. {int(background[i+1])}'
+                zone_texts[i].set_text(f'{first}\n{second}')
 
             # now fill the information frame
-            angle_zone_left_right = 33/3 # angle between center and left / right zone in degrees
-            angle_zone_up_down = 32/3    # angle between center and up / down zone in degrees
-
-            center = pick_best(obj[4*4:])
-            top = pick_best(obj[1*4:])
-            bottom = pick_best(obj[7*4:])
-            left = pick_best(obj[3*4:])
-            right = pick_best(obj[5*4:])
-
-            top_angle = calc_angle(center, top, angle_zone_up_down)
-            bottom_angle = calc_angle(center, bottom, angle_zone_up_down)
-            left_angle = calc_angle(center, left, angle_zone_left_right)
-            right_angle = calc_angle(center, right, angle_zone_left_right)
-            ax_info.annotate(tof_id, (0.5, 0.7), ha='center', va='center')
+            # use the target with higher confidence of each zone - the first one if both are equal
+            targets = obj[:9*4].reshape(9, 2, 2)  # zone, target, (distance, confidence)
+            best_target = targets[:, :, 1].argmax(axis=1)
+            best_dist = targets[np.arange(9), best_target, 0]
+            center = best_dist[4]
+            edges = best_dist[[1, 7, 3, 5]]  # top, bottom, left, right zone
+
+            top_angle, bottom_angle, left_angle, right_angle = calc_angles(center, edges, _SIN_ALPHAS, _COS_ALPHAS)
+            info_id.set_text(tof_id)
             text_color = 'darkblue'
             max_angle_deviation = 15
             if (top_angle + bottom_angle > max_angle_deviation) or (left_angle + right_angle > max_angle_deviation):
                 text_color = 'red'
-            ax_info.annotate(f'(Angles: left {left_angle:6.1f}° right {right_angle:6.1f}°    top {top_angle:6.1f}° bottom {bottom_angle:6.1f}°)',
-                             (0.5, 0.5), ha='center', va='center')
-            ax_info.annotate(f'Vertical axis (yaw) {(left_angle-right_angle)/2:6.1f}°      Lateral axis (pitch) {(top_angle-bottom_angle)/2:6.1f}°',
-                             (0.5, 0.3), ha='center', va='center', color=text_color)
+            info_angles.set_text(f'(Angles: left {left_angle:6.1f}° right {right_angle:6.1f}°    top {top_angle:6.1f}° bottom {bottom_angle:6.1f}°)')
+            info_axes.set_text(f'Vertical axis (yaw) {(left_angle-right_angle)/2:6.1f}°      Lateral axis (pitch) {(top_angle-bottom_angle)/2:6.1f}°')
+            info_axes.set_color(text_color)
             # now show 3d animation
-            ax3d.bar3d([0], [0], [0], [1], [1], [1], shade=True, color='cornflowerblue')
             ax3d.view_init(elev=(top_angle-bottom_angle)/2, azim=(right_angle-left_angle)/2)
 
-        except IndexError:
-            pass   # ignore it...
+        except (IndexError, ValueError):
+            pass   # ignore it... incomplete object data
     else:
-        ax_info.annotate('No Device Connected', (0.1, 0.5), ha='left', va='center', color='red')
+        for text in zone_texts + [info_id, info_angles, info_axes]:
+            text.set_text('')
+        info_error.set_text('No Device Connected')
+    return artists
 
 
 global ani
@@ -245,9 +363,14 @@ host = "localhost"  # the EVM GUI should be run on the same computer
 port = 39998  # ToF EVM Automation port 
 
 try:
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # send the short commands without Nagle delay
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 256*1024)  # room for a whole measurement; set before connect
     sock.connect((host, port))
     sock.settimeout(1)  # 1s timeout
     sock.sendall(b'(i4000)') # 4 M iterations
+    start_measurement(sock)  # further measurements are requested by get_data_from_EVM_GUI
+    calc_angles(1.0, np.ones(4))  # warm up - first call compiles the numba kernel (if installed)
+    threading.Thread(target=reader_loop, args=(sock,), daemon=True).start()  # socket timeouts are handled in there
     # fig, axs = plt.subplots(3, 3, figsize=(7, 5)) # create figure
     fig = plt.figure(constrained_layout=True, figsize=(10, 6))
     spec = gridspec.GridSpec(ncols=5, nrows=4, figure=fig)
@@ -256,11 +379,12 @@ try:
         axs[i] = fig.add_subplot(spec[int(i/3) + 1, i % 3])
     axs[9] = fig.add_subplot(spec[0, :])  # information row - spans whole first row
     axs[10] = fig.add_subplot(spec[1:, -2:], projection='3d') # 3d view; last column
-    axs[10].set_title('3d View')
+    axs[10].set_title('3d View', y=0.92)  # keep title inside the axes - it is redrawn with every frame
 
-    animate(0, axs, sock) # first call to see if we have errors
+    zone_texts, info_texts = init_artists(axs)
 
-    ani = animation.FuncAnimation(fig, animate, fargs=[axs, sock], interval=300)
+    ani = animation.FuncAnimation(fig, animate, fargs=[axs, sock, zone_texts, info_texts],
+                                  interval=FRAME_BUDGET_MS, blit=True, cache_frame_data=False)
     plt.show()
 
 except socket.error as e: